@@ -1,166 +1,258 @@
 import streamlit as st
 import os
 import zipfile
-import subprocess
 import tempfile
 import shutil
+import functools
 from pathlib import Path
-from datetime import datetime
-import re
+import numpy as np
 import pandas as pd
 from PIL import Image
-import xml.etree.ElementTree as ET
-import platform
-import requests
-
-# --- Costanti per TSL -----------------------------------------------------
-TSL_FILE = Path("img/TSL-IT.xml")
-TRUST_PEM = Path("tsl-ca.pem")
-
-def build_trust_store(tsl_path: Path, out_pem: Path):
-    ns = {
-        'tsl': 'http://uri.etsi.org/02231/v2#',
-        'ds':  'http://www.w3.org/2000/09/xmldsig#'
-    }
-    tree = ET.parse(tsl_path)
-    certs = tree.getroot().findall('.//ds:X509Certificate', ns)
-    if not certs:
-        raise RuntimeError(f"Nessun certificato trovato in {tsl_path}")
-    with open(out_pem, 'wb') as f:
-        for cert in certs:
-            b64 = cert.text.strip() if cert.text else ""
-            if len(b64) < 200:
-                continue
-            f.write(b"-----BEGIN CERTIFICATE-----\n")
-            for i in range(0, len(b64), 64):
-                f.write(b64[i:i+64].encode('ascii') + b"\n")
-            f.write(b"-----END CERTIFICATE-----\n\n")
+from concurrent.futures import ThreadPoolExecutor
+from cades_utils import (
+    TSL_FILE, TRUST_PEM, MAX_WORKERS, COPY_BUFSIZE, MAX_ZIP_DEPTH, RAM_TMP,
+    ExtractionResult, build_trust_store, extract_signed_content, work_tmp_dir,
+    extract_and_unpack, extract_zip, write_zip_entry,
+    collect_output_files,
+)
+
+@st.cache_resource(show_spinner=False)
+def get_trust_pem(tsl_mtime_ns: int) -> Path:
+    # Una volta per processo e per versione del TSL (mtime nella chiave),
+    # non a ogni rerun; il PEM su disco si riscrive solo se mancante o vecchio
+    if not TRUST_PEM.exists() or TRUST_PEM.stat().st_mtime_ns < tsl_mtime_ns:
+        build_trust_store(TSL_FILE, TRUST_PEM)
+    return TRUST_PEM
 
 try:
-    build_trust_store(TSL_FILE, TRUST_PEM)
+    get_trust_pem(TSL_FILE.stat().st_mtime_ns)
 except Exception as e:
     st.error(f"Impossibile costruire il trust store: {e}")
     st.stop()
 
+@st.cache_resource(show_spinner=False)
+def load_logo(path: str) -> Image.Image:
+    # Decodificato una volta per processo invece che a ogni rerun
+    with Image.open(path) as img:
+        img.load()
+        return img.copy()
+
 col1, col2 = st.columns([7, 3])
 with col1:
     st.title("ImperialSign 🔒📜")
     st.caption("Estrai con fiducia. Verifica la firma digitale. Archivia con ordine. 🛡️✅")
 with col2:
-    logo = Image.open("img/Consip_Logo.png")
-    st.image(logo, width=300)
-
-# --- Funzione di estrazione con fallback e avvisi ------------------------
-def extract_signed_content(p7m_path: Path, out_dir: Path) -> tuple[Path | None, str, bool]:
-    base = p7m_path.stem
-    payload_out = out_dir / base
-    cert_pem = out_dir / f"{base}_cert.pem"
-
-    # Estrai certificato firmatario
-    subprocess.run([
-        "openssl", "pkcs7", "-inform", "DER", "-in", str(p7m_path),
-        "-print_certs", "-out", str(cert_pem)
-    ], capture_output=True)
-
-    # Estraggo payload con cms noverify
-    proc = subprocess.run([
-        "openssl", "cms", "-verify", "-in", str(p7m_path),
-        "-inform", "DER", "-noverify", "-out", str(payload_out)
-    ], capture_output=True, text=True)
-
-    if proc.returncode != 0:
-        err = proc.stderr.lower()
-        if "bad signature" in err:
-            st.warning(
-                f"{p7m_path.name}: firma non valida. Estraggo contenuto ma verifica date.")
-            # Fallback con smime
-            fallback = subprocess.run([
-                "openssl", "smime", "-verify", "-inform", "DER",
-                "-in", str(p7m_path), "-noverify", "-out", str(payload_out)
-            ], capture_output=True, text=True)
-            if fallback.returncode != 0:
-                st.error(f"Estrazione fallback fallita: {fallback.stderr.strip()}")
-                cert_pem.unlink(missing_ok=True)
-                return None, "", False
-        else:
-            st.error(f"Errore estrazione '{p7m_path.name}': {proc.stderr.strip()}")
-            cert_pem.unlink(missing_ok=True)
-            return None, "", False
-
-    # Rinomina in .pdf se riconosce PDF
-    try:
-        with open(payload_out, 'rb') as f:
-            if f.read(4) == b'%PDF':
-                new_pdf = payload_out.with_suffix('.pdf')
-                payload_out.rename(new_pdf)
-                payload_out = new_pdf
-    except Exception:
-        pass
-
-    # Leggi info certificato
-    cert_info = subprocess.run([
-        "openssl", "x509", "-in", str(cert_pem),
-        "-noout", "-subject", "-dates"
-    ], capture_output=True, text=True)
-    cert_pem.unlink(missing_ok=True)
-    if cert_info.returncode != 0:
-        st.error(f"Impossibile leggere info certificato per '{p7m_path.name}'")
-        return payload_out, "Sconosciuto", False
-
-    lines = cert_info.stdout.splitlines()
-    subj = "\n".join(lines)
-    m = re.search(r"CN\s*=\s*([^,\/]+)", subj)
-    signer = m.group(1).strip() if m else "Sconosciuto"
-
-    # Verifica date
-    fmt = "%b %d %H:%M:%S %Y %Z"
-    try:
-        start = next(l for l in lines if 'notBefore' in l).split('=',1)[1].strip()
-        end = next(l for l in lines if 'notAfter' in l).split('=',1)[1].strip()
-        valid = datetime.strptime(start, fmt) <= datetime.utcnow() <= datetime.strptime(end, fmt)
-    except Exception:
-        valid = False
-
-    return payload_out, signer, valid
-
-# --- ZIP annidati e flatten -----------------------------------------------
-def recursive_unpack_and_flatten(d: Path):
-    for z in d.rglob("*.zip"):
-        if not z.is_file():
+    st.image(load_logo("img/Consip_Logo.png"), width=300)
+
+# --- Avvisi dell'estrazione -----------------------------------------------
+def show_messages(messages: list[tuple[str, str]]):
+    for level, text in messages:
+        (st.warning if level == "warning" else st.error)(text)
+
+# --- Processa .p7m ----------------------------------------------------------
+RESULT_COLUMNS = ["Origine", "File estratto", "Firmatario", "Validità"]
+
+def result_row(origin: str, res: ExtractionResult, level: int = 0) -> tuple:
+    return (origin, "↳ " * level + res.payload.name, res.signer, '✅' if res.valid else '⚠️')
+
+def submit_p7m(pool: ThreadPoolExecutor, locks: dict, p7m_paths) -> list:
+    # Coppie (.p7m, future) per collect_results, che così sa a quale file
+    # attribuire un errore del worker
+    return [(p7m, pool.submit(extract_and_unpack, p7m, locks)) for p7m in p7m_paths]
+
+def collect_results(jobs: list, submit, origin: str,
+                    rows: list, messages: list):
+    # Visita in profondità con una pila di livelli invece della ricorsione:
+    # ogni livello elabora solo i .p7m usciti dal payload ZIP del livello
+    # sopra, senza riscandire la cartella (né rielaborare i .p7m falliti).
+    # Il lavoro gira nei worker (submit accoda i .p7m e restituisce le
+    # coppie come submit_p7m); righe e avvisi raccolti in rows e messages.
+    # Un worker fallito diventa un errore per quel file, non per tutto l'upload
+    stack = [iter(jobs)]
+    while stack:
+        job = next(stack[-1], None)
+        if job is None:
+            stack.pop()
             continue
-        dst = z.parent / f"{z.stem}_unz"
-        shutil.rmtree(dst, ignore_errors=True)
-        dst.mkdir()
+        p7m, future = job
         try:
-            with zipfile.ZipFile(z) as zf:
-                zf.extractall(dst)
-        except Exception:
-            z.unlink(missing_ok=True)
+            res = future.result()
+        except Exception as e:
+            messages.append(("error", f"Errore estrazione '{p7m.name}': {e}"))
             continue
-        z.unlink(missing_ok=True)
-        children = list(dst.iterdir())
-        if len(children) == 1 and children[0].is_dir():
-            for c in children[0].iterdir():
-                shutil.move(str(c), dst)
-            children[0].rmdir()
-        recursive_unpack_and_flatten(dst)
-
-# --- Processa directory di .p7m -------------------------------------------
-def process_p7m_dir(d: Path, indent=""):
-    for p7m in d.rglob("*.p7m"):
-        payload, signer, valid = extract_signed_content(p7m, p7m.parent)
+        messages.extend(res.messages)
+        payload = res.payload
         if not payload:
             continue
-        p7m.unlink(missing_ok=True)
-        st.write(f"{indent}– {payload.name} | {signer} | {'✅' if valid else '⚠️'}")
-        if payload.suffix.lower() == ".zip":
-            try:
-                with zipfile.ZipFile(payload) as zf:
-                    zf.extractall(payload.parent)
-                recursive_unpack_and_flatten(payload.parent)
-            except Exception:
-                st.error(f"Errore estrazione ZIP interno di {payload.name}")
-            process_p7m_dir(payload.parent, indent + "  ")
+        rows.append(result_row(origin, res, len(stack) - 1))
+        if res.nested:
+            if len(stack) > MAX_ZIP_DEPTH:
+                messages.append(("warning",
+                    f"Annidamento oltre {MAX_ZIP_DEPTH} livelli in {payload.name}: mi fermo"))
+                continue
+            stack.append(iter(submit(res.nested)))
+
+def save_upload(up, dst: Path):
+    # Copia a blocchi dal file caricato, senza materializzarlo in un unico bytes
+    up.seek(0)
+    with open(dst, 'wb') as f:
+        shutil.copyfileobj(up, f, COPY_BUFSIZE)
+
+def upload_footprint(up) -> int | None:
+    # Byte che un caricamento occuperà nella cartella di lavoro: per gli ZIP
+    # l'upload salvato più le dimensioni non compresse della directory
+    # centrale; per gli altri il file più il payload estratto. None se la
+    # directory centrale non si legge (l'errore lo riporta poi unzip_upload)
+    if Path(up.name).suffix.lower() == ".zip":
+        try:
+            up.seek(0)
+            with zipfile.ZipFile(up) as zf:
+                return up.size + sum(i.file_size for i in zf.infolist())
+        except Exception:
+            return None
+    return 2 * up.size
+
+def work_dir_for(uploads) -> str | None:
+    # tmpfs solo se abilitato e con ingombro noto; altrimenti None (la
+    # cartella temporanea di sistema), senza aprire gli ZIP caricati
+    if not RAM_TMP:
+        return None
+    sizes = [upload_footprint(up) for up in uploads]
+    return None if None in sizes else work_tmp_dir(sum(sizes))
+
+def extract_upload(up, root: Path) -> ExtractionResult:
+    # .p7m caricato singolarmente: salvataggio ed estrazione nel worker
+    tmpd = Path(tempfile.mkdtemp(prefix="proc_", dir=root))
+    try:
+        fp = tmpd / up.name
+        save_upload(up, fp)
+        return extract_signed_content(fp, root)
+    finally:
+        shutil.rmtree(tmpd, ignore_errors=True)
+
+def unzip_upload(up, root: Path) -> list[Path]:
+    # ZIP caricato: salvataggio ed estrazione nel worker. Cartella di lavoro
+    # dentro root: stesso filesystem, quindi il risultato si sposta in
+    # root/<nome> con un rename invece di una copytree. Restituisce i .p7m
+    # estratti, presi dall'elenco dei file scritti invece di riscandire
+    # (senza doppioni: voci ripetute nello ZIP riscrivono lo stesso file)
+    tmpd = Path(tempfile.mkdtemp(prefix="proc_", dir=root))
+    try:
+        fp = tmpd / up.name
+        save_upload(up, fp)
+        # L'upload resta fuori dalla cartella estratta, che contiene solo il risultato
+        exd = tmpd / "estratti"
+        exd.mkdir()
+        written = []
+        with zipfile.ZipFile(fp) as zf:
+            extract_zip(zf, exd, written=written)
+        target = root / fp.stem
+        shutil.rmtree(target, ignore_errors=True)
+        exd.rename(target)
+        return [target / f.relative_to(exd) for f in dict.fromkeys(written)
+                if f.suffix.lower() == ".p7m"]
+    finally:
+        shutil.rmtree(tmpd, ignore_errors=True)
+
+# --- Anteprima struttura ZIP ----------------------------------------------
+@st.cache_data(show_spinner=False)
+def build_preview_df(paths: tuple[str, ...]) -> pd.DataFrame:
+    # Chiave = elenco delle voci: lo ZIP viene riscritto a ogni rerun (nuovo
+    # percorso e mtime), ma se il contenuto non cambia la tabella è in cache
+    rows = [p.split("/") for p in paths]
+    max_levels = max(map(len, rows))
+    grid = np.full((len(rows), max_levels), "", dtype=object)
+    for i, r in enumerate(rows):
+        grid[i, :len(r)] = r
+    # Svuota in un colpo solo le celle uguali a quella della riga precedente
+    dup = np.zeros(grid.shape, dtype=bool)
+    dup[1:] = grid[1:] == grid[:-1]
+    grid[dup] = ""
+    return pd.DataFrame(grid, columns=[f"Liv {i+1}" for i in range(max_levels)])
+
+# --- Pipeline completa, in cache tra i rerun --------------------------------
+def release_output(output: tuple):
+    # Chiamata quando la voce esce dalla cache (fine sessione, ttl, max_entries)
+    Path(output[0]).unlink(missing_ok=True)
+
+@st.cache_resource(show_spinner="Estrazione in corso…",
+                   scope="session", ttl="30m", max_entries=2,
+                   validate=lambda output: os.path.exists(output[0]),
+                   on_release=release_output)
+def build_output(upload_key: tuple, _uploads) -> tuple[str, tuple[str, ...], tuple, tuple]:
+    # Chiave = (file_id, nome, dimensione) dei caricamenti: un rerun con gli
+    # stessi file (es. clic su "Scarica") non rifà estrazioni e verifiche.
+    # Cache per sessione e a tempo: in cache c'è solo il percorso dello ZIP
+    # su disco, rimosso da release_output. Nessuna chiamata st.* qui dentro:
+    # avvisi e righe tornano come dati e li mostra il chiamante
+    uploads = _uploads
+    # Cartella di lavoro rimossa all'uscita dal blocco, anche se un passo
+    # solleva un'eccezione
+    with tempfile.TemporaryDirectory(prefix="combined_", ignore_cleanup_errors=True,
+                                     dir=work_dir_for(uploads)) as tmp:
+        root = Path(tmp)
+        exts = [Path(up.name).suffix.lower() for up in uploads]
+        # ZIP con lo stesso nome finirebbero nella stessa cartella: vale l'ultimo
+        last_zip = {Path(up.name).stem: n for n, (up, ext) in enumerate(zip(uploads, exts))
+                    if ext == ".zip"}
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            # Lock per cartella di questa elaborazione, liberati con lei
+            submit = functools.partial(submit_p7m, pool, {})
+            # Tutti i caricamenti partono subito nel pool: salvataggio ed
+            # estrazione dei .p7m singoli e degli ZIP in parallelo tra loro
+            jobs = [pool.submit(extract_upload, up, root) if ext == ".p7m"
+                    else pool.submit(unzip_upload, up, root)
+                    if ext == ".zip" and last_zip[Path(up.name).stem] == n
+                    else None
+                    for n, (up, ext) in enumerate(zip(uploads, exts))]
+            # I .p7m di tutti gli ZIP finiscono nello stesso pool, non un lotto
+            # per ZIP: un archivio con pochi file non lascia core inattivi
+            batches = {}
+            for n, (ext, job) in enumerate(zip(exts, jobs)):
+                if ext == ".zip" and job is not None and job.exception() is None:
+                    batches[n] = submit(job.result())
+            # Risultati nell'ordine di caricamento, raccolti in un'unica tabella
+            # invece di una riga st.write per file; avvisi ed errori restano singoli
+            rows = []
+            messages = []
+            for n, (up, ext, job) in enumerate(zip(uploads, exts, jobs)):
+                name = up.name
+
+                if ext == ".zip":
+                    if job is None:
+                        messages.append(("warning",
+                            f"{name}: sostituito da un ZIP caricato dopo con lo stesso nome"))
+                        continue
+                    try:
+                        if job.exception() is not None:
+                            raise job.exception()
+                        collect_results(batches[n], submit, name, rows, messages)
+                    except Exception as e:
+                        messages.append(("error", f"Errore unzip {name}: {e}"))
+
+                elif ext == ".p7m":
+                    res = job.result()
+                    messages.extend(res.messages)
+                    if res.payload:
+                        rows.append(result_row(name, res))
+
+                else:
+                    messages.append(("warning", f"Ignoro {name}"))
+
+        # Creazione ZIP finale in un file temporaneo con nome, fuori dalla
+        # cartella di lavoro: sopravvive al blocco e i byte si leggono solo al
+        # download. Le voci per l'anteprima si prendono dal ZipFile appena scritto
+        fd, zip_path = tempfile.mkstemp(prefix="estratti_", suffix=".zip")
+        try:
+            with os.fdopen(fd, 'wb') as out, \
+                    zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+                for file, arcname in collect_output_files(root):
+                    write_zip_entry(zf, file, arcname)
+                paths = [i.filename for i in zf.infolist()]
+        except BaseException:
+            Path(zip_path).unlink(missing_ok=True)
+            raise
+        return zip_path, tuple(paths), tuple(messages), tuple(rows)
 
 # --- Flusso principale Streamlit -----------------------------------------
 output_name = st.text_input("Nome ZIP di output (.zip):", value="all_extracted.zip")
@@ -168,75 +260,21 @@ output_filename = output_name if output_name.lower().endswith(".zip") else outpu
 
 uploads = st.file_uploader("Carica .p7m o ZIP", accept_multiple_files=True)
 if uploads:
-    root = Path(tempfile.mkdtemp(prefix="combined_"))
-    for up in uploads:
-        name = up.name
-        ext = Path(name).suffix.lower()
-        tmpd = Path(tempfile.mkdtemp(prefix="proc_"))
-        fp = tmpd / name
-        fp.write_bytes(up.getbuffer())
-
-        if ext == ".zip":
-            st.write(f"🔄 ZIP: {name}")
-            try:
-                with zipfile.ZipFile(fp) as zf:
-                    zf.extractall(tmpd)
-                recursive_unpack_and_flatten(tmpd)
-                target = root / fp.stem
-                shutil.rmtree(target, ignore_errors=True)
-                shutil.copytree(tmpd, target)
-                process_p7m_dir(target)
-            except Exception as e:
-                st.error(f"Errore unzip: {e}")
-            finally:
-                shutil.rmtree(tmpd, ignore_errors=True)
-
-        elif ext == ".p7m":
-            st.write(f"🔄 .p7m: {name}")
-            payload, signer, valid = extract_signed_content(fp, root)
-            if payload:
-                st.write(f"– {payload.name} | {signer} | {'✅' if valid else '⚠️'}")
-            shutil.rmtree(tmpd, ignore_errors=True)
-
-        else:
-            st.warning(f"Ignoro {name}")
-
-    # Pulizia residui
-    for d in root.rglob("*_unz"):
-        shutil.rmtree(d, ignore_errors=True)
-    for p in root.rglob("*.p7m"):
-        p.unlink(missing_ok=True)
-
-    # Creazione ZIP finale e anteprima struttura
-    outd = Path(tempfile.mkdtemp(prefix="zip_out_"))
-    zipf = outd / output_filename
-    with zipfile.ZipFile(zipf, 'w', zipfile.ZIP_DEFLATED) as zf:
-        for path in root.iterdir():
-            if path.is_dir():
-                for file in path.rglob('*'):
-                    if file.is_file() and '_unz' not in file.parts and file.suffix.lower() != '.p7m':
-                        zf.write(file, file.relative_to(root))
-            else:
-                if path.suffix.lower() != '.p7m':
-                    zf.write(path, path.name)
+    zip_path, paths, messages, rows = build_output(
+        tuple((up.file_id, up.name, up.size) for up in uploads), uploads)
+    show_messages(messages)
+    if rows:
+        st.dataframe(pd.DataFrame(rows, columns=RESULT_COLUMNS), hide_index=True)
 
     st.subheader("Anteprima struttura ZIP risultante")
-    with zipfile.ZipFile(zipf) as zf:
-        paths = [i.filename for i in zf.infolist()
-                 if '_unz' not in i.filename and not i.filename.lower().endswith('.p7m')]
     if paths:
-        rows = [p.split("/") for p in paths]
-        max_levels = max(len(r) for r in rows)
-        cols = [f"Liv {i+1}" for i in range(max_levels)]
-        df = pd.DataFrame([r + [""]*(max_levels-len(r)) for r in rows], columns=cols)
-        for c in cols:
-            df[c] = df[c].mask(df[c] == df[c].shift(), "")
-        st.table(df)
-
-    with open(zipf, 'rb') as f:
-        st.download_button(
-            "Scarica estratti",
-            data=f,
-            file_name=output_filename,
-            mime="application/zip"
-        )
+        st.table(build_preview_df(paths))
+
+    st.download_button(
+        "Scarica estratti",
+        # Callable: Streamlit legge il file solo quando si clicca, senza
+        # tenerne i byte in memoria tra un rerun e l'altro
+        data=Path(zip_path).read_bytes,
+        file_name=output_filename,
+        mime="application/zip"
+    )
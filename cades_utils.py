@@ -0,0 +1,419 @@
+# Funzioni di estrazione e verifica CAdES senza dipendenze da Streamlit:
+# importate una volta per processo, le cache restano valide tra i rerun
+import os
+import zipfile
+import subprocess
+import io
+import hashlib
+import functools
+import shutil
+import threading
+from pathlib import Path
+from datetime import datetime, timezone
+import warnings
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+from cryptography.hazmat.primitives.serialization import Encoding, pkcs7
+from cryptography.x509.oid import NameOID
+try:
+    from asn1crypto import cms
+except ImportError:  # opzionale: senza asn1crypto si usa solo openssl
+    cms = None
+
+# --- Costanti per TSL -----------------------------------------------------
+TSL_FILE = Path("img/TSL-IT.xml")
+TRUST_PEM = Path("tsl-ca.pem")
+MAX_WORKERS = os.cpu_count() or 1
+# Blocchi di copia per l'estrazione degli ZIP (zipfile usa 64 KiB)
+COPY_BUFSIZE = 1024 * 1024
+# Oltre questa soglia i ZIP interni passano dal disco invece che dalla RAM.
+# Ogni livello annidato tiene vivo il buffer del padre e i worker sono
+# cpu_count: al massimo MAX_ZIP_DEPTH × 4 MiB per worker, qualunque sia il
+# rapporto di compressione dell'upload
+INMEMORY_ZIP_LIMIT = 4 * 1024 * 1024
+# Livelli massimi di ZIP/.p7m annidati: oltre si scarta (difesa da ZIP quine)
+MAX_ZIP_DEPTH = 8
+# Cartella di lavoro in RAM (tmpfs) solo su richiesta, con ESTRAZIONE_RAM_TMP=1:
+# /dev/shm è spesso piccolo (64 MB di default in Docker) e condiviso tra sessioni
+RAM_TMP = ("/dev/shm" if os.environ.get("ESTRAZIONE_RAM_TMP") == "1"
+           and os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else None)
+# Margine su tmpfs oltre all'ingombro stimato (ZIP annidati, altre sessioni)
+RAM_TMP_FACTOR = 2
+
+# Le buste CAdES sono spesso in BER (lunghezze indefinite): cryptography le
+# legge comunque, ma avvisa a ogni file
+warnings.filterwarnings("ignore", message="PKCS#7 certificates could not be parsed as DER")
+
+# Attributi del soggetto usabili come nome del firmatario, in ordine di priorità
+SIGNER_OIDS = {oid: i for i, oid in enumerate((
+    NameOID.COMMON_NAME, NameOID.SURNAME, NameOID.USER_ID,
+    NameOID.EMAIL_ADDRESS, NameOID.SERIAL_NUMBER))}
+
+def build_trust_store(tsl_path: Path, out_pem: Path):
+    # Parsing in streaming del TSL: niente DOM completo in memoria, ogni
+    # elemento viene svuotato appena letto
+    cert_tag = '{http://www.w3.org/2000/09/xmldsig#}X509Certificate'
+    buf = bytearray()
+    found = False
+    for _, elem in ET.iterparse(tsl_path):
+        if elem.tag == cert_tag:
+            found = True
+            # Rimuove eventuali a capo/spazi interni prima di riformattare a 64
+            b64 = "".join(elem.text.split()) if elem.text else ""
+            if len(b64) >= 200:
+                chunks = (b64[i:i+64].encode('ascii') for i in range(0, len(b64), 64))
+                buf += b"-----BEGIN CERTIFICATE-----\n"
+                buf += b"\n".join(chunks)
+                buf += b"\n-----END CERTIFICATE-----\n\n"
+        elem.clear()
+    if not found:
+        raise RuntimeError(f"Nessun certificato trovato in {tsl_path}")
+    # PEM costruito interamente in memoria e scritto con una sola write
+    out_pem.write_bytes(bytes(buf))
+
+def work_tmp_dir(nbytes: int) -> str | None:
+    # nbytes = ingombro stimato su disco (contenuto estratto, non dimensione
+    # caricata); tmpfs solo se c'è margine, altrimenti None (la cartella
+    # temporanea di sistema)
+    if RAM_TMP and shutil.disk_usage(RAM_TMP).free >= nbytes * RAM_TMP_FACTOR:
+        return RAM_TMP
+    return None
+
+# Con -noverify il trust store di sistema non serve: non caricarlo evita di
+# rileggere file e cartella delle CA a ogni processo openssl
+OPENSSL_NO_STORE = ["-no-CAfile", "-no-CApath", "-no-CAstore"]
+
+# --- Funzione di estrazione con fallback e avvisi ------------------------
+# Estensione del contenuto estratto in base ai primi 4 byte
+PAYLOAD_MAGIC = {
+    b"%PDF": ".pdf",
+    b"PK\x03\x04": ".zip",
+    b"<?xm": ".xml",
+    b"\xff\xd8\xff\xe0": ".jpg",
+    b"\x89PNG": ".png",
+}
+
+@dataclass
+class ExtractionResult:
+    payload: Path | None
+    signer: str = ""
+    valid: bool = False
+    # Avvisi (livello, testo) da mostrare nel thread principale: Streamlit
+    # non va chiamato dai worker
+    messages: list[tuple[str, str]] = field(default_factory=list)
+    # Contenuto di un payload ZIP tenuto in memoria e non scritto su disco
+    archive: bytes | None = None
+    # .p7m usciti dal payload ZIP, da elaborare al livello successivo
+    nested: list[Path] = field(default_factory=list)
+
+def signer_certificate(certs: list[x509.Certificate]) -> x509.Certificate:
+    # Il firmatario è il primo certificato non-CA della busta (le CA della
+    # catena possono precederlo); in mancanza, il primo
+    for cert in certs:
+        try:
+            if not cert.extensions.get_extension_for_class(x509.BasicConstraints).value.ca:
+                return cert
+        except x509.ExtensionNotFound:
+            return cert
+    return certs[0]
+
+@functools.lru_cache(maxsize=512)
+def load_cert_info(der: bytes) -> tuple[x509.Certificate, str]:
+    # Molti file dello stesso firmatario: parsing del certificato e scelta del
+    # nome fatti una volta per certificato (chiave = DER)
+    cert = x509.load_der_x509_certificate(der)
+    # Una sola passata sul soggetto, tenendo l'attributo a priorità più alta
+    signer = min(((SIGNER_OIDS[a.oid], a.value.strip()) for a in cert.subject
+                  if a.oid in SIGNER_OIDS),
+                 default=(len(SIGNER_OIDS), "Sconosciuto"))[1]
+    return cert, signer
+
+# Digest gestiti dalla verifica in-process (nome asn1crypto/hashlib)
+CMS_HASHES = {
+    "sha1": hashes.SHA1, "sha224": hashes.SHA224, "sha256": hashes.SHA256,
+    "sha384": hashes.SHA384, "sha512": hashes.SHA512,
+}
+
+def cms_verify_inprocess(data: bytes) -> tuple[bytes, bytes] | None:
+    # Equivalente in-process di 'openssl cms -verify -noverify': estrae il
+    # contenuto e verifica la firma (non la catena). Per buste non gestite o
+    # firme non valide restituisce None e la decisione passa a openssl
+    try:
+        signed = cms.ContentInfo.load(data)['content']
+        encap = signed['encap_content_info']
+        content = encap['content'].native
+        if content is None:
+            return None
+        certs = [c.chosen for c in signed['certificates'] if c.name == 'certificate']
+        signer = None
+        for si in signed['signer_infos']:
+            sid = si['sid']
+            if sid.name == 'issuer_and_serial_number':
+                cert = next(c for c in certs if c.issuer == sid.chosen['issuer']
+                            and c.serial_number == sid.chosen['serial_number'].native)
+            else:
+                cert = next(c for c in certs if c.key_identifier == sid.chosen.native)
+            digest_name = si['digest_algorithm']['algorithm'].native
+            hash_alg = CMS_HASHES[digest_name]()
+            attrs = si['signed_attrs']
+            if len(attrs):
+                found = {a['type'].native: a['values'][0].native for a in attrs}
+                if found.get('message_digest') != hashlib.new(digest_name, content).digest():
+                    return None
+                if found.get('content_type', encap['content_type'].native) != encap['content_type'].native:
+                    return None
+                # Si firma il SET degli attributi, non il tag implicito [0]
+                to_verify = b'\x31' + attrs.dump()[1:]
+            else:
+                to_verify = content
+            der = cert.dump()
+            key = load_cert_info(der)[0].public_key()
+            algo = si['signature_algorithm'].signature_algo
+            sig = si['signature'].native
+            if algo == 'rsassa_pkcs1v15' and isinstance(key, rsa.RSAPublicKey):
+                key.verify(sig, to_verify, padding.PKCS1v15(), hash_alg)
+            elif algo == 'ecdsa' and isinstance(key, ec.EllipticCurvePublicKey):
+                key.verify(sig, to_verify, ec.ECDSA(hash_alg))
+            else:
+                return None
+            signer = signer or der
+        return (content, signer) if signer is not None else None
+    except Exception:
+        return None
+
+def extract_signed_content(p7m_path: Path, out_dir: Path,
+                           zip_in_memory: bool = False) -> ExtractionResult:
+    messages = []
+    base = p7m_path.stem
+    data = p7m_path.read_bytes()
+
+    # Busta gestita in-process quando possibile; altrimenti openssl, che
+    # produce anche i messaggi d'errore
+    verified = cms_verify_inprocess(data) if cms is not None else None
+    if verified is not None:
+        content, cert_der = verified
+    else:
+        cert_der = None
+        # Estraggo payload con cms noverify: busta da stdin, contenuto su stdout
+        proc = subprocess.run([
+            "openssl", "cms", "-verify", "-inform", "DER", "-noverify", *OPENSSL_NO_STORE
+        ], input=data, capture_output=True)
+
+        if proc.returncode != 0:
+            err = proc.stderr.decode(errors="replace")
+            if "bad signature" in err.lower():
+                messages.append(("warning",
+                    f"{p7m_path.name}: firma non valida. Estraggo contenuto ma verifica date."))
+                # Fallback con smime
+                proc = subprocess.run([
+                    "openssl", "smime", "-verify", "-inform", "DER", "-noverify",
+                    *OPENSSL_NO_STORE
+                ], input=data, capture_output=True)
+                if proc.returncode != 0:
+                    messages.append(("error",
+                        f"Estrazione fallback fallita: {proc.stderr.decode(errors='replace').strip()}"))
+                    return ExtractionResult(None, messages=messages)
+            else:
+                messages.append(("error", f"Errore estrazione '{p7m_path.name}': {err.strip()}"))
+                return ExtractionResult(None, messages=messages)
+        content = proc.stdout
+
+    # Nome finale deciso in memoria, una sola scrittura: i PDF prendono sempre
+    # .pdf, gli altri formati noti solo se il nome non ha già un'estensione
+    # (un .docx inizia anch'esso con PK e non va trattato come ZIP)
+    payload_out = out_dir / base
+    suffix = PAYLOAD_MAGIC.get(content[:4], "")
+    if suffix == ".pdf" or (suffix and not payload_out.suffix):
+        payload_out = payload_out.with_suffix(suffix)
+    # Un payload ZIP che verrà subito estratto può restare in memoria
+    archive = None
+    if (zip_in_memory and payload_out.suffix.lower() == ".zip"
+            and len(content) <= INMEMORY_ZIP_LIMIT):
+        archive = content
+    else:
+        payload_out.write_bytes(content)
+
+    # Leggi certificato firmatario in-process, dai certificati già nella busta
+    if cert_der is None:
+        try:
+            cert_der = signer_certificate(
+                pkcs7.load_der_pkcs7_certificates(data)).public_bytes(Encoding.DER)
+        except Exception:
+            messages.append(("error", f"Impossibile leggere info certificato per '{p7m_path.name}'"))
+            return ExtractionResult(payload_out, "Sconosciuto", False, messages, archive)
+    cert, signer = load_cert_info(cert_der)
+
+    # Verifica date
+    valid = cert.not_valid_before_utc <= datetime.now(timezone.utc) <= cert.not_valid_after_utc
+
+    return ExtractionResult(payload_out, signer, valid, messages, archive)
+
+# --- ZIP annidati e flatten -----------------------------------------------
+def single_top_dir(names: list[str]) -> str | None:
+    # Prefisso "cartella/" se tutte le voci stanno sotto un'unica cartella radice
+    tops = {n.split('/', 1)[0] for n in names if n}
+    if len(tops) != 1:
+        return None
+    prefix = tops.pop() + '/'
+    return prefix if all(n.startswith(prefix) for n in names if n) else None
+
+def extract_zip(zf: zipfile.ZipFile, dst: Path, strip: str = "",
+                depth: int = 0, seen: frozenset = frozenset(),
+                written: list[Path] | None = None):
+    # Come extractall (stessa bonifica dei percorsi: niente assoluti né
+    # "..") ma copiando a blocchi da COPY_BUFSIZE; strip toglie un prefisso.
+    # Gli ZIP annidati finiscono già estratti in <nome>_unz (dalla memoria o,
+    # se grandi, dal disco); seen contiene gli sha256 degli ZIP antenati,
+    # per riconoscere i cicli; written, se dato, raccoglie i file scritti
+    for info in zf.infolist():
+        name = info.filename[len(strip):] if strip else info.filename
+        parts = [p for p in os.path.splitdrive(name)[1].split('/')
+                 if p not in ('', '.', '..')]
+        if not parts:
+            continue
+        target = dst.joinpath(*parts)
+        if info.is_dir():
+            target.mkdir(parents=True, exist_ok=True)
+            continue
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if target.suffix.lower() == ".zip" and info.file_size <= INMEMORY_ZIP_LIMIT:
+            unpack_nested_zip(zf.read(info), target.parent / f"{target.stem}_unz",
+                              depth + 1, seen, written)
+            continue
+        with zf.open(info) as src, open(target, 'wb') as out:
+            shutil.copyfileobj(src, out, COPY_BUFSIZE)
+        if target.suffix.lower() == ".zip":
+            unpack_zip_file(target, depth + 1, seen, written)
+        elif written is not None:
+            written.append(target)
+
+def unpack_nested_zip(data: bytes, dst: Path, depth: int = 1,
+                      seen: frozenset = frozenset(),
+                      written: list[Path] | None = None):
+    # Stesso risultato di unpack_zip_file su uno ZIP annidato, ma dalla
+    # memoria: lo ZIP intermedio non viene scritto né riletto
+    digest = hashlib.sha256(data).digest()
+    if depth > MAX_ZIP_DEPTH or digest in seen:
+        return  # troppo profondo o contenuto in se stesso: si scarta
+    shutil.rmtree(dst, ignore_errors=True)
+    dst.mkdir()
+    try:
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            extract_zip(zf, dst, single_top_dir(zf.namelist()) or "",
+                        depth, seen | {digest}, written)
+    except Exception:
+        pass  # come in unpack_zip_file, lo ZIP illeggibile si scarta
+
+def unpack_zip_file(z: Path, depth: int = 1, seen: frozenset = frozenset(),
+                    written: list[Path] | None = None):
+    # ZIP annidato troppo grande per la RAM: estratto da disco in <nome>_unz
+    # e poi rimosso; quello illeggibile o troppo profondo si scarta
+    if depth <= MAX_ZIP_DEPTH:
+        dst = z.parent / f"{z.stem}_unz"
+        shutil.rmtree(dst, ignore_errors=True)
+        dst.mkdir()
+        try:
+            with zipfile.ZipFile(z) as zf:
+                # Flatten durante l'estrazione: le voci sotto un'unica cartella
+                # radice vengono scritte direttamente in dst, senza spostarle dopo
+                extract_zip(zf, dst, single_top_dir(zf.namelist()) or "",
+                            depth, seen, written)
+        except Exception:
+            pass
+    z.unlink(missing_ok=True)
+
+# Protegge le mappe dei lock per cartella passate a extract_and_unpack
+_unpack_locks_guard = threading.Lock()
+
+def extract_and_unpack(p7m_path: Path,
+                       locks: dict[Path, threading.Lock]) -> ExtractionResult:
+    # Lavoro completo di un .p7m dentro una cartella, eseguito nel worker:
+    # estrazione, rimozione della busta e, per un payload ZIP, estrazione
+    # del contenuto accanto al payload (che poi viene rimosso) e raccolta
+    # dei .p7m che conteneva. locks = un lock per cartella, creato da chi
+    # avvia l'elaborazione e che vive quanto lei: i payload ZIP estratti
+    # nella stessa cartella da worker diversi non si scrivono sopra a vicenda
+    res = extract_signed_content(p7m_path, p7m_path.parent, zip_in_memory=True)
+    payload = res.payload
+    if not payload:
+        return res
+    p7m_path.unlink(missing_ok=True)
+    if payload.suffix.lower() != ".zip":
+        return res
+    with _unpack_locks_guard:
+        lock = locks.setdefault(payload.parent, threading.Lock())
+    src = io.BytesIO(res.archive) if res.archive is not None else payload
+    with lock:
+        written = []
+        try:
+            with zipfile.ZipFile(src) as zf:
+                extract_zip(zf, payload.parent, written=written)
+            payload.unlink(missing_ok=True)
+        except Exception:
+            if res.archive is not None and not payload.exists():
+                payload.write_bytes(res.archive)
+            res.messages.append(("error", f"Errore estrazione ZIP interno di {payload.name}"))
+        # Senza doppioni, nell'ordine di scrittura: una voce ripetuta nello
+        # ZIP riscrive lo stesso file e non va accodata due volte
+        res.nested = [f for f in dict.fromkeys(written) if f.suffix.lower() == ".p7m"]
+    res.archive = None
+    return res
+
+# --- Compressione nello ZIP finale ----------------------------------------
+# PDF, ZIP, JPEG e PNG sono già compressi: ricomprimerli costa CPU senza
+# ridurre la dimensione
+COMPRESSED_MAGIC = (b"%PDF", b"PK\x03\x04", b"\xff\xd8\xff", b"\x89PNG")
+# Estensioni riconosciute senza aprire il file
+COMPRESSED_SUFFIXES = {".pdf", ".zip", ".jpg", ".jpeg", ".png", ".p7m",
+                       ".docx", ".xlsx", ".pptx", ".odt", ".ods"}
+
+def zip_compress_type(path: str) -> int:
+    if os.path.splitext(path)[1].lower() in COMPRESSED_SUFFIXES:
+        return zipfile.ZIP_STORED
+    with open(path, 'rb') as f:
+        head = f.read(4)
+    return zipfile.ZIP_STORED if head.startswith(COMPRESSED_MAGIC) else zipfile.ZIP_DEFLATED
+
+def write_zip_entry(zf: zipfile.ZipFile, path: str, arcname: str):
+    # zf.write copia a blocchi da 8 KiB: per le voci ZIP_STORED il costo è
+    # tutto CRC32 e copia, quindi si passa da zf.open con blocchi da
+    # COPY_BUFSIZE. Le voci compresse restano a zf.write, che applica il
+    # compresslevel dello ZIP
+    compress_type = zip_compress_type(path)
+    if compress_type != zipfile.ZIP_STORED:
+        zf.write(path, arcname, compress_type=compress_type)
+        return
+    info = zipfile.ZipInfo.from_file(path, arcname)
+    info.compress_type = zipfile.ZIP_STORED
+    with open(path, 'rb') as src, zf.open(info, 'w') as dst:
+        shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+
+def scan_files(root, skip_dir=lambda name: False):
+    # os.scandir riporta il tipo della voce senza una stat per file; stesso
+    # ordine di os.walk: prima i file della cartella, poi le sottocartelle
+    subdirs = []
+    with os.scandir(root) as it:
+        for e in it:
+            if e.is_dir(follow_symlinks=False):
+                if not skip_dir(e.name):
+                    subdirs.append(e.path)
+            elif e.is_file():
+                yield e
+    for sd in subdirs:
+        yield from scan_files(sd, skip_dir)
+
+def collect_output_files(root: Path) -> list[tuple[str, str]]:
+    # Unica visita dell'albero: salta le cartelle *_unz e i .p7m rimasti.
+    # Coppie (percorso, nome nello ZIP) ricavate dal DirEntry per slicing,
+    # senza oggetti Path né relative_to per file. Ordinate per cartella e
+    # nome: letture sequenziali e ZIP identico a parità di contenuto,
+    # qualunque sia l'ordine del filesystem
+    skip = len(str(root)) + 1
+    files = [(e.path, e.path[skip:])
+             for e in scan_files(root, lambda name: name.endswith('_unz'))
+             if not e.name.lower().endswith('.p7m')]
+    return sorted(files, key=lambda f: (os.path.dirname(f[1]).split(os.sep),
+                                        os.path.basename(f[1])))
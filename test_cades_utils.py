@@ -0,0 +1,108 @@
+# Verifica CMS in-process confrontata con 'openssl cms', su buste create al
+# volo con 'openssl cms -sign': RSA, EC, senza attributi firmati, BER e
+# manomessa. Eseguire con: python -m pytest
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+import cades_utils
+from cades_utils import cms_verify_inprocess, extract_signed_content, OPENSSL_NO_STORE
+
+pytest.importorskip("asn1crypto")
+if shutil.which("openssl") is None:
+    pytest.skip("openssl non disponibile", allow_module_level=True)
+
+CONTENT = b"%PDF-1.4\n% documento di prova\n"
+
+KEYS = {
+    "rsa": ["-newkey", "rsa:2048"],
+    "ec": ["-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1"],
+}
+# Nome della busta -> (chiave, opzioni aggiuntive di 'openssl cms -sign')
+ENVELOPES = {
+    "rsa": ("rsa", []),
+    "ec": ("ec", []),
+    "noattr": ("rsa", ["-noattr"]),
+    # -stream produce lunghezze indefinite (BER), come molte buste CAdES reali
+    "ber": ("rsa", ["-stream"]),
+}
+
+def openssl(*args, data: bytes | None = None) -> subprocess.CompletedProcess:
+    return subprocess.run(["openssl", *args], input=data, capture_output=True)
+
+@pytest.fixture(scope="module")
+def pki(tmp_path_factory) -> dict[str, tuple[Path, Path]]:
+    # Certificato autofirmato e chiave per ogni algoritmo
+    d = tmp_path_factory.mktemp("pki")
+    out = {}
+    for name, newkey in KEYS.items():
+        cert, key = d / f"{name}.pem", d / f"{name}.key"
+        proc = openssl("req", "-x509", *newkey, "-nodes", "-days", "30",
+                       "-subj", "/CN=Mario Rossi", "-keyout", str(key), "-out", str(cert))
+        assert proc.returncode == 0, proc.stderr
+        out[name] = (cert, key)
+    return out
+
+@pytest.fixture(scope="module")
+def envelopes(pki, tmp_path_factory) -> dict[str, Path]:
+    d = tmp_path_factory.mktemp("p7m")
+    doc = d / "doc.pdf"
+    doc.write_bytes(CONTENT)
+    out = {}
+    for name, (key_name, extra) in ENVELOPES.items():
+        cert, key = pki[key_name]
+        p7m = d / f"{name}.pdf.p7m"
+        proc = openssl("cms", "-sign", "-binary", "-nodetach", "-outform", "DER",
+                       "-in", str(doc), "-signer", str(cert), "-inkey", str(key),
+                       "-out", str(p7m), *extra)
+        assert proc.returncode == 0, proc.stderr
+        out[name] = p7m
+    # Busta RSA con il contenuto alterato dopo la firma
+    data = out["rsa"].read_bytes()
+    tampered = d / "tampered.pdf.p7m"
+    tampered.write_bytes(data.replace(b"documento", b"Documento"))
+    out["tampered"] = tampered
+    return out
+
+def cert_der(cert: Path) -> bytes:
+    return openssl("x509", "-in", str(cert), "-outform", "DER").stdout
+
+def openssl_verify(p7m: Path) -> subprocess.CompletedProcess:
+    return openssl("cms", "-verify", "-inform", "DER", "-noverify", *OPENSSL_NO_STORE,
+                   data=p7m.read_bytes())
+
+@pytest.mark.parametrize("name", ENVELOPES)
+def test_inprocess_matches_openssl(envelopes, pki, name):
+    proc = openssl_verify(envelopes[name])
+    assert proc.returncode == 0, proc.stderr
+    verified = cms_verify_inprocess(envelopes[name].read_bytes())
+    assert verified is not None
+    content, signer = verified
+    assert content == proc.stdout == CONTENT
+    assert signer == cert_der(pki[ENVELOPES[name][0]][0])
+
+def test_tampered_is_rejected(envelopes):
+    assert cms_verify_inprocess(envelopes["tampered"].read_bytes()) is None
+    assert openssl_verify(envelopes["tampered"]).returncode != 0
+
+def test_garbage_is_rejected():
+    assert cms_verify_inprocess(b"non una busta CMS") is None
+
+@pytest.mark.parametrize("name", [*ENVELOPES, "tampered"])
+def test_fallback_matches_inprocess(envelopes, tmp_path, monkeypatch, name):
+    # Stesso risultato con la verifica in-process e con il solo openssl
+    # (asn1crypto assente)
+    results = []
+    for mode, cms_module in (("inprocess", cades_utils.cms), ("openssl", None)):
+        monkeypatch.setattr(cades_utils, "cms", cms_module)
+        out_dir = tmp_path / mode
+        out_dir.mkdir()
+        res = extract_signed_content(envelopes[name], out_dir)
+        payload = res.payload.read_bytes() if res.payload else None
+        results.append((res.payload and res.payload.name, payload, res.signer, res.valid,
+                        [level for level, _ in res.messages]))
+    assert results[0] == results[1]
+    if name != "tampered":
+        assert results[0] == (f"{name}.pdf", CONTENT, "Mario Rossi", True, [])